@@ -14,12 +14,37 @@
 # CONFIG
 #########################################
 
-AUDIO_DEVICE_ID = 1                     # change this number to use another soundcard
+AUDIO_DEVICE_ID = 1                     # change this number (or set it to a part of the device name, e.g. "USB Audio") to use another soundcard
+SAMPLERATE = 44100                      # Output sample rate (samples recorded at another rate still play at their pitch)
+AUDIO_BLOCKSIZE = 512                   # Frames per audio block (512 is 11.6 ms at 44.1 kHz), or 0 to autotune: use the smallest block this machine renders safely at MAX_POLYPHONY
+AUDIO_LATENCY = 'high'                  # PortAudio output latency with a fixed block size: 'low', 'high' or a number of seconds
+AUTOTUNE_HEADROOM = 0.5                 # With autotune, rendering a block must take less than this share of its duration
+AUTOTUNE_PER_PRESET = False             # With autotune, measure again when a preset selects another interpolation (the sound stops for a moment)
 SAMPLES_DIR = "."                       # The root directory containing the sample-sets. Example: "/media/" to look for samples on a USB stick / SD card
 USE_SERIALPORT_MIDI = False             # Set to True to enable MIDI IN via SerialPort (e.g. RaspberryPi's GPIO UART pins)
+MIDI_IGNORED_PORTS = ["Midi Through"]   # MIDI input ports not opened (a part of their name)
+MIDI_PORT_ROUTING = {}                  # e.g. {"nanoKEY": {"channel": 2}, "Pads": {"channels": [10], "ignore": ["control", "pitchbend"]}}: for the input ports whose name contains a key ("Serial" for the serial port), only some channels are taken, some message types ("note", "polypressure", "control", "program", "pressure", "pitchbend") are ignored, and/or all messages are sent to one channel
 USE_I2C_7SEGMENTDISPLAY = False         # Set to True to use a 7-segment display via I2C
 USE_BUTTONS = False                      # Set to True to use momentary buttons (connected to RaspberryPi's GPIO pins) to change preset
 MAX_POLYPHONY = 80                      # This can be set higher, but 80 is a safe value
+VOICE_STEALING = "released"             # Voice stolen when MAX_POLYPHONY is reached: "released" (released voices first), "quietest", "oldest" or "samenote" (same note first)
+STEALING_FADE_MS = 5                    # Stolen voices fade out over this many milliseconds instead of being cut
+MIXER_THREADS = 1                       # Set to the number of CPU cores (e.g. 4 on a Pi 3/4) to render dense passages on several cores (see setup.py for the OpenMP build)
+MULTITIMBRAL = False                    # Set to True to give each MIDI channel its own preset (selected by program changes on that channel), volume, transpose and sustain pedal, e.g. for splits and layers
+PART_PRESETS = {1: 0}                   # With MULTITIMBRAL, preset of each MIDI channel at startup, e.g. {1: 0, 2: 5} (the other channels are silent until a program change)
+INTERPOLATION = "linear"                # Resampling quality of the presets that don't set %%interpolation: "linear", "cubic" (~2x the CPU per voice) or "sinc" (~3x)
+LOADING_THREADS = 4                     # Number of threads decoding the samples of a preset
+MEMORY_RESERVE_MB = 64                  # RAM kept free when loading a preset while the previous one is still playing
+USE_LOADER_PROCESS = False              # Set to True to decode the samples of a preset in another process, into shared memory, so that loading doesn't slow down the audio thread (not with USE_DISK_STREAMING)
+LOADER_SHM_DIR = "/dev/shm"             # RAM-backed directory through which the loader process hands the samples over
+RESAMPLE_CACHE_MB = 0                   # RAM used to resample at load the notes that have no sample of their own, so that the mixer doesn't pitch them in real time (0 to disable)
+PRESET_CACHE_MB = 256                   # RAM used to keep recently played presets loaded, so that switching back to them is instant (0 to disable)
+USE_DISK_STREAMING = False              # Set to True to keep only the beginning of each sample in RAM and stream the rest from disk (for sample-sets bigger than the RAM)
+STREAMING_PRELOAD_FRAMES = 32768        # Number of frames of each sample kept in RAM when streaming (looped samples are always fully loaded)
+EFFECTS_BYPASS_LOAD = 0.8               # The master effects (EQ and reverb) are bypassed while the audio callback takes more than this share of the block duration
+TELEMETRY_LOG = None                    # e.g. "/tmp/samplerbox.log": file to which engine statistics (render load, xruns, voices, MIDI latency) are appended as JSON lines
+TELEMETRY_PORT = None                   # e.g. 9999: also send these lines as UDP datagrams to this port of localhost
+TELEMETRY_INTERVAL = 5                  # Seconds covered by each line of statistics
 
 USE_I2C_16X2DISPLAY = False				# Set to True to use a 16x2 display via I2C
 										# Define some device parameters
@@ -35,12 +60,21 @@ import wave
 import time
 import numpy
 import os
+import sys
 import re
-import sounddevice
+import json
+import copy
+import math
+import socket
 import threading
 from chunk import Chunk
+from multiprocessing.pool import ThreadPool
 import struct
-import rtmidi_python as rtmidi
+import weakref
+import collections
+import select
+import subprocess
+import tempfile
 import samplerbox_audio
 import random
 
@@ -99,6 +133,9 @@ class waveread(wave.Wave_read):
     def getmarkers(self):
         return self._cue
 
+    def getdataoffset(self):
+        return self._file.offset + self._data_chunk.offset
+
     def getloops(self):
         return self._loops
 
@@ -110,45 +147,100 @@ class waveread(wave.Wave_read):
 
 class PlayingSound:
 
-    def __init__(self, sound, note):
+    def __init__(self, sound, part, note, offset):
         self.sound = sound
-        self.pos = 0
-        self.fadeoutpos = 0
-        self.isfadeout = False
         self.note = note
+        if sound.streamed:                      # the mixer reads a per-voice ring buffer, refilled by the streaming thread
+            self.data = streamingrings.pop() if streamingrings else StreamingRing()
+            initial = min(len(sound.data), sound.channels * STREAMING_CHUNK_FRAMES)     # the streaming thread copies the rest of the preloaded part
+            self.data[:initial] = sound.data[:initial]
+            self.mask = STREAMING_RING_FRAMES - 1
+            self.filled = initial / sound.channels
+            self.stream = None
+        else:
+            self.data = sound.data
+            self.mask = -1
+            self.filled = sound.nframes
+        gainl, gainr = PanGains(part.pan, sound.channels)
+        speed = SPEED[note - sound.midinote] * sound.framerate / SAMPLERATE
+        self.voice = voices.play(self.data, sound.nframes, sound.loop, speed, note, self.mask, self.filled, offset, part.interpolation,
+                                 sound.channels, gainl * part.volume, gainr * part.volume, part.index)
 
     def fadeout(self, i):
-        self.isfadeout = True
+        voices.fadeout(self.voice)
 
     def stop(self):
-        try:
-            playingsounds.remove(self)
-        except:
-            pass
+        voices.stop(self.voice)
+
+    def refill(self):
+        sound = self.sound
+        pos = voices.getpos(self.voice)
+        if pos < 0:
+            return
+        end = min(int(pos) - samplerbox_audio.KERNEL_HISTORY_FRAMES + STREAMING_RING_FRAMES, sound.nframes)      # frames older than those read by the kernels around pos can be overwritten
+        preloaded = len(sound.data) / sound.channels
+        while self.filled < end:
+            start = self.filled & self.mask
+            n = min(end - self.filled, STREAMING_CHUNK_FRAMES, STREAMING_RING_FRAMES - start)
+            if self.filled < preloaded:
+                chunk = sound.data[sound.channels * self.filled:sound.channels * min(self.filled + n, preloaded)]
+            else:
+                if not self.stream:
+                    self.stream = open(sound.fname, 'rb')
+                self.stream.seek(sound.dataoffset + self.filled * sound.framesize)
+                chunk = sound.frames2array(self.stream.read(n * sound.framesize), sound.sampwidth, sound.numchan)
+            n = len(chunk) / sound.channels
+            if n == 0:
+                break
+            self.data[sound.channels * start:sound.channels * (start + n)] = chunk
+            self.filled += n
+            voices.setfilled(self.voice, self.filled)
+
+    def close(self):
+        # called once the voice has stopped, when the mixer doesn't read its ring buffer anymore
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.sound.streamed:
+            streamingrings.append(self.data)
 
 
 class Sound:
 
-    def __init__(self, filename, midinote, velocity, seq):
+    def __init__(self, filename, midinote, velocity, seq, streaming=USE_DISK_STREAMING, loopcrossfade=0):
         wf = waveread(filename)
         self.fname = filename
         self.midinote = midinote
         self.velocity = velocity
         self.seq = seq
-        if wf.getloops():
+        if wf.getloops() and wf.getloops()[0][0] < min(wf.getloops()[0][1], wf.getnframes() - 1):
             self.loop = wf.getloops()[0][0]
-            self.nframes = wf.getloops()[0][1] + 2
+            self.nframes = min(wf.getloops()[0][1], wf.getnframes() - 1) + 1      # the voice wraps to the loop start after the loop end
         else:
             self.loop = -1
             self.nframes = wf.getnframes()
-
-        self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
+        self.channels = wf.getnchannels()          # samples are kept mono or stereo, as in the file
+        self.framerate = wf.getframerate()
+
+        self.streamed = streaming and self.loop == -1 and self.nframes > STREAMING_PRELOAD_FRAMES
+        if self.streamed:
+            self.sampwidth = wf.getsampwidth()
+            self.numchan = wf.getnchannels()
+            self.framesize = self.sampwidth * self.numchan
+            self.dataoffset = wf.getdataoffset()
+            self.data = self.frames2array(wf.readframes(STREAMING_PRELOAD_FRAMES), self.sampwidth, self.numchan)
+        else:
+            self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
+            if self.loop >= 0:
+                self.data = LoopGuard(self.data, self.channels, self.loop, self.nframes, int(loopcrossfade * self.framerate / 1000))
 
         wf.close()
 
-    def play(self, note):
-        snd = PlayingSound(self, note)
-        playingsounds.append(snd)
+    def play(self, part, note, offset=0):
+        snd = PlayingSound(self, part, note, offset)
+        if self.streamed:
+            streamingvoices.append(snd)
+            StreamingEvent.set()
         return snd
 
     def frames2array(self, data, sampwidth, numchan):
@@ -156,24 +248,212 @@ class Sound:
             npdata = numpy.fromstring(data, dtype=numpy.int16)
         elif sampwidth == 3:
             npdata = samplerbox_audio.binary24_to_int16(data, len(data)/3)
-        if numchan == 1:
-            npdata = numpy.repeat(npdata, 2)
         return npdata
 
+
+def LoopGuard(data, channels, loop, nframes, crossfade):
+    # returns the frames of a looped sound followed by copies of the first frames of its loop, that the mixer reads
+    # when it interpolates across the loop end; the end of the loop is first crossfaded over crossfade frames with
+    # the frames before the loop start, which the loop start follows without a click
+    frames = numpy.empty((nframes + samplerbox_audio.LOOP_GUARD_FRAMES, channels), numpy.int16)
+    frames[:nframes] = data[:channels * nframes].reshape(-1, channels)
+    crossfade = min(crossfade, loop, nframes - loop)
+    if crossfade > 0:
+        fade = (numpy.arange(1, crossfade + 1, dtype=numpy.float32) / (crossfade + 1))[:, numpy.newaxis]
+        before = data[channels * (loop - crossfade):channels * loop].reshape(-1, channels)
+        frames[nframes - crossfade:nframes] = numpy.round(frames[nframes - crossfade:nframes] * (1 - fade) + before * fade)
+    frames[nframes:] = frames[loop + numpy.arange(samplerbox_audio.LOOP_GUARD_FRAMES) % (nframes - loop)]
+    return frames.ravel()
+
+
+#########################################
+# SAMPLE MAP
+#
+#########################################
+
+ROUND_ROBIN_LENGTH = 32                 # length of the precomputed random order of the alternate samples of a note
+RESAMPLE_LOOP_TOLERANCE = 0.0006        # largest pitch error of a loop resampled at load (about 1 cent), due to its rounded length
+
+
+class SampleMap:
+    # The samples of a preset: a 128x128 table giving, for each (note, velocity), the index of the group of
+    # alternate samples it plays (-1 for none), and for each group a precomputed random order of its samples.
+    # A map is built from the {(note, velocity): [sounds]} loaded so far and never modified afterwards
+    # (except for the order cursors), so the audio thread always sees a complete one.
+
+    def __init__(self, loaded={}, previous=None):
+        self.table = numpy.empty((128, 128), numpy.int16)
+        self.table.fill(-1)
+        self.orders = {}                        # {(note, velocity): (number of sounds, order)}
+        self.groups = []
+        for key in sorted(loaded):
+            sounds = loaded[key]
+            size, order = previous.orders.get(key, (0, None)) if previous else (0, None)
+            if size != len(sounds):             # reused while its group doesn't change
+                order = RoundRobinOrder(sounds)
+            self.orders[key] = (len(sounds), order)
+            self.table[key] = len(self.groups)
+            self.groups.append(order)
+        self.cursors = [0] * len(self.groups)
+        FillSamples(self.table)
+
+    def next(self, midinote, velocity):
+        # returns the sound to play for a note and velocity, or None
+        if not 0 <= midinote < 128:
+            return None
+        group = self.table.item(midinote, velocity)
+        if group < 0:
+            return None
+        order = self.groups[group]
+        cursor = self.cursors[group]
+        self.cursors[group] = cursor + 1 if cursor + 1 < len(order) else 0
+        return order[cursor]
+
+
+def RoundRobinOrder(sounds):
+    # a random sequence of shuffles of the alternate samples of a note (so that each of them plays as often), which
+    # avoids playing the same seq twice in a row when there are 3 samples or more (not even when it wraps around)
+    if len(sounds) == 1:
+        return list(sounds)
+    norepeat = len(sounds) >= 3
+    order = []
+    shuffles = max(1, ROUND_ROBIN_LENGTH / len(sounds))
+    for i in xrange(shuffles):
+        shuffle = list(sounds)
+        for attempt in xrange(20):             # seqs shared by several samples can make it impossible
+            random.shuffle(shuffle)
+            seqs = [sound.seq for sound in order[-1:] + shuffle + (order[:1] if i == shuffles - 1 else [])]
+            if not norepeat or all(a != b for a, b in zip(seqs, seqs[1:])):
+                break
+        order += shuffle
+    return order
+
+
+def FillSamples(table):
+    # velocity fill-in of each note from its loaded velocities, and neighbour-note fill-in of the notes that have no samples
+    velocities = numpy.arange(128)
+    for midinote in xrange(128):
+        row = table[midinote]
+        loaded = numpy.nonzero(row >= 0)[0]
+        if len(loaded):
+            row[:] = row[loaded[numpy.maximum(numpy.searchsorted(loaded, velocities, 'right') - 1, 0)]]
+        elif midinote > 0:
+            row[:] = table[midinote - 1]
+
+
+class ResampledSound(Sound):
+    # a sound pitched to another note at load, that the mixer plays at speed 1
+
+    def __init__(self, sound, midinote, speed, loop, nframes):
+        self.fname = sound.fname
+        self.midinote = midinote
+        self.velocity = sound.velocity
+        self.seq = sound.seq
+        self.loop = loop
+        self.nframes = nframes
+        self.channels = sound.channels
+        self.framerate = SAMPLERATE
+        self.streamed = False
+        self.data = samplerbox_audio.resample(sound.data, sound.channels, sound.nframes, sound.loop, speed, nframes)
+        if loop >= 0:
+            self.data = LoopGuard(self.data, self.channels, loop, nframes, 0)
+
+
+def Resample(sound, midinote):
+    # returns sound resampled for midinote, or None for a loop too short to keep its pitch once its length is rounded
+    speed = float(SPEED[midinote - sound.midinote]) * sound.framerate / SAMPLERATE
+    if sound.loop < 0:
+        return ResampledSound(sound, midinote, speed, -1, int((sound.nframes - 1) / speed) + 1)
+    period = sound.nframes - sound.loop
+    newperiod = int(round(period / speed))
+    if newperiod < 1 or abs(period / (speed * newperiod) - 1) > RESAMPLE_LOOP_TOLERANCE:
+        return None
+    speed = float(period) / newperiod
+    loop = int(round(sound.loop / speed))
+    return ResampledSound(sound, midinote, speed, loop, loop + newperiod)
+
+
+def ResampleNotes(loaded, budget):
+    # returns the {(note, velocity): [sounds]} of the notes filled in from a lower note, resampled up to budget
+    # bytes, the nearest to their samples first; None if the loading was interrupted
+    notes = sorted(set(note for note, velocity in loaded))
+    filled = []
+    for midinote in xrange(128):
+        lower = [note for note in notes if note <= midinote]
+        if lower and lower[-1] != midinote and midinote - lower[-1] < len(SPEED):
+            filled.append((midinote - lower[-1], midinote, lower[-1]))
+    resampled = {}
+    for distance, midinote, source in sorted(filled):
+        keys = [key for key in loaded if key[0] == source]
+        if sum(len(sound.data) * 2 / SPEED[distance] for key in keys for sound in loaded[key]) > budget:
+            break
+        for key in keys:
+            if LoadingInterrupt:
+                return None
+            sounds = []
+            for sound in loaded[key]:
+                r = Resample(sound, midinote) if not sound.streamed else None
+                if r:
+                    budget -= r.data.nbytes
+                sounds.append(r or sound)           # pitched in real time
+            resampled[(midinote, key[1])] = sounds
+    return resampled
+
+
 FADEOUTLENGTH = 30000
 FADEOUT = numpy.linspace(1., 0., FADEOUTLENGTH)            # by default, float64
 FADEOUT = numpy.power(FADEOUT, 6)
 FADEOUT = numpy.append(FADEOUT, numpy.zeros(FADEOUTLENGTH, numpy.float32)).astype(numpy.float32)
 SPEED = numpy.power(2, numpy.arange(0.0, 84.0)/12).astype(numpy.float32)
+STREAMING_RING_FRAMES = 2 << (STREAMING_PRELOAD_FRAMES - 1).bit_length()     # power of two, twice the preloaded part
+STREAMING_CHUNK_FRAMES = 8192
+STREAMING_SPARE_RINGS = 16              # ring buffers besides one per voice, for the voices stolen or ended that the streaming thread hasn't released yet
+
+voices = samplerbox_audio.VoicePool(MAX_POLYPHONY, threads=MIXER_THREADS, stealing=samplerbox_audio.STEALING[VOICE_STEALING], stealframes=STEALING_FADE_MS * SAMPLERATE / 1000)
+midievents = samplerbox_audio.EventQueue(1024)
+effects = samplerbox_audio.Effects(SAMPLERATE, EFFECTS_BYPASS_LOAD)
+telemetry = samplerbox_audio.Telemetry()
+streamingvoices = []
 
-samples = {}
-playingnotes = {}
-lastplayedseq = {}
-sustainplayingnotes = []
-sustain = False
-playingsounds = []
-globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
-globaltranspose = 0
+
+def PanGains(pan, channels):
+    # left and right gains of a voice for a pan position from -1 (left) to 1 (right): constant power for a
+    # mono sample (unity gain in both channels when centred), balance for a stereo one
+    if channels == 1:
+        angle = (pan + 1) * math.pi / 4
+        return math.cos(angle) * math.sqrt(2), math.sin(angle) * math.sqrt(2)
+    return min(1.0, 1.0 - pan), min(1.0, 1.0 + pan)
+
+
+#########################################
+# PARTS
+# (one per MIDI channel)
+#########################################
+
+class Part:
+    # What a MIDI channel plays: its preset, with its own volume, transpose and sustain pedal. All parts are
+    # rendered by the same voice pool, tagged with their index; without MULTITIMBRAL only the first one is used.
+
+    def __init__(self, index):
+        self.index = index                      # MIDI channel - 1
+        self.preset = None                      # silent until a preset is selected
+        self.source = None                      # (dirname, signature, params) of the loaded preset
+        self.samples = SampleMap()
+        self.playingnotes = {}
+        self.sustainplayingnotes = []
+        self.sustain = False
+        self.volume = 10 ** (-12.0/20)          # -12dB default volume
+        self.transpose = 0
+        self.interpolation = samplerbox_audio.INTERPOLATIONS[INTERPOLATION]
+        self.pan = 0.0
+
+
+def MidiPart(status):
+    # the part a channel message is for (the first one for all channels without MULTITIMBRAL)
+    return parts[status & 15] if MULTITIMBRAL else parts[0]
+
+
+parts = [Part(index) for index in xrange(16)]
 
 
 #########################################
@@ -181,24 +461,33 @@ globaltranspose = 0
 #
 #########################################
 
-def AudioCallback(outdata, frame_count, time_info, status):
-    global playingsounds
-    rmlist = []
-    playingsounds = playingsounds[-MAX_POLYPHONY:]
-    b = samplerbox_audio.mixaudiobuffers(playingsounds, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED)
-    for e in rmlist:
-        try:
-            playingsounds.remove(e)
-        except:
-            pass
-    b *= globalvolume
-    outdata[:] = b.reshape(outdata.shape)
-
-def MidiCallback(message, time_stamp):
-    global playingnotes, sustain, sustainplayingnotes, lastplayedseq
-    global preset
+def AudioCallback(outdata, frame_count, time_info, status, now=None):
+    started = time.time()
+    if now is None:                                                 # offline rendering passes the time of its own clock
+        now = started
+    blockstart = now - float(frame_count) / SAMPLERATE              # messages are played one block later, at the same position in the block
+    outputlatency = time_info.outputBufferDacTime - time_info.currentTime if time_info else 0      # until this block is heard
+    for messagestatus, data1, data2, timestamp in midievents.drain():
+        offset = min(max(int((timestamp - blockstart) * SAMPLERATE), 0), frame_count - 1)
+        ProcessMidi([messagestatus, data1, data2], offset)
+        telemetry.latency(now + outputlatency + float(offset) / SAMPLERATE - timestamp)
+    voices.mix(outdata, frame_count, FADEOUT, FADEOUTLENGTH, 1, effects)
+    rendertime = time.time() - started
+    telemetry.block(rendertime, float(frame_count) / SAMPLERATE, voices, status and status.output_underflow, status and status.output_overflow, effects.bypassed)
+    effects.watch(rendertime * SAMPLERATE / frame_count)
+
+def MidiCallback(message, time_stamp, now=None):
+    if message[0] >> 4 == 12:   # Program change: the preset is loaded from here, never from the audio thread
+        print 'Program change ' + str(message[1])
+        part = MidiPart(message[0])
+        part.preset = message[1]
+        LoadSamples(part)
+    elif message[0] < 0xF0:     # everything else is applied by the audio callback
+        midievents.push(message[0], message[1] if len(message) > 1 else 0, message[2] if len(message) > 2 else 0, time.time() if now is None else now)
+
+def ProcessMidi(message, offset):
+    part = MidiPart(message[0])
     messagetype = message[0] >> 4
-    messagechannel = (message[0] & 15) + 1
     note = message[1] if len(message) > 1 else None
     midinote = note
     velocity = message[2] if len(message) > 2 else None
@@ -207,52 +496,35 @@ def MidiCallback(message, time_stamp):
         messagetype = 8
 
     if messagetype == 9:    # Note on
-        midinote += globaltranspose
+        midinote += part.transpose
         try:
-            # Get the list of available samples for this note and velocity
-            notesamples = samples[midinote, velocity]
-            
-            # Choose a sample from the list
-            sample = random.choice (notesamples)
-            
-            # If we have no value for lastplayedseq, set it to 0
-            lastplayedseq.setdefault(midinote, 0)
-
-            # If we have more than 2 samples to work with, reject duplicates
-            if len(notesamples) >= 3:
-                while sample.seq == lastplayedseq[midinote]:
-                    sample = random.choice (notesamples)
-
-            # print "About to play midinote: %s, seq: %s" % (midinote, sample.seq)
-            playingnotes.setdefault(midinote, []).append(sample.play(midinote))
-            # Recorded the last played note
-            lastplayedseq[midinote] = sample.seq
+            # The next of the samples available for this note and velocity, in their precomputed random order
+            sample = part.samples.next(midinote, velocity)
+            if sample:      # keyed by the received note, so that the note-off finds it after a transpose change
+                part.playingnotes.setdefault(note, []).append(sample.play(part, midinote, offset))
         except:
             pass
 
     elif messagetype == 8:  # Note off
-        midinote += globaltranspose
-        if midinote in playingnotes:
-            for n in playingnotes[midinote]:
-                if sustain:
-                    sustainplayingnotes.append(n)
+        if note in part.playingnotes:
+            for n in part.playingnotes[note]:
+                if part.sustain:
+                    part.sustainplayingnotes.append(n)
                 else:
                     n.fadeout(50)
-            playingnotes[midinote] = []
-
-    elif messagetype == 12:  # Program change
-        print 'Program change ' + str(note)
-        preset = note
-        LoadSamples()
+            part.playingnotes[note] = []
 
     elif (messagetype == 11) and (note == 64) and (velocity < 64):  # sustain pedal off
-        for n in sustainplayingnotes:
+        for n in part.sustainplayingnotes:
             n.fadeout(50)
-        sustainplayingnotes = []
-        sustain = False
+        part.sustainplayingnotes = []
+        part.sustain = False
 
     elif (messagetype == 11) and (note == 64) and (velocity >= 64):  # sustain pedal on
-        sustain = True
+        part.sustain = True
+
+    elif (messagetype == 11) and (note == 120):  # all sound off
+        voices.stopall(part.index)
 
 
 #########################################
@@ -262,60 +534,84 @@ def MidiCallback(message, time_stamp):
 
 LoadingThread = None
 LoadingInterrupt = False
+LOADING_FILL_INTERVAL = 0.1             # seconds between two fill-ins of the samples map while a preset is loading
+loadqueue = []                          # parts whose preset is to be loaded, the first one is loading
+loadinglock = threading.Lock()
 
 
-def LoadSamples():
+def LoadSamples(part=None):
+    # loads the preset of a part (the first one by default) in the loading thread, after those of the parts
+    # already waiting; a part whose preset is loading starts again with its new one
     global LoadingThread
     global LoadingInterrupt
+    part = part or parts[0]
 
-    if LoadingThread:
-        LoadingInterrupt = True
-        LoadingThread.join()
-        LoadingThread = None
-
-    LoadingInterrupt = False
-    LoadingThread = threading.Thread(target=ActuallyLoad)
-    LoadingThread.daemon = True
-    LoadingThread.start()
-
-NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
+    with loadinglock:
+        if part in loadqueue:
+            if part is loadqueue[0]:
+                LoadingInterrupt = True
+            return
+        loadqueue.append(part)
+        if len(loadqueue) == 1:
+            LoadingThread = threading.Thread(target=LoadParts)
+            LoadingThread.daemon = True
+            LoadingThread.start()
 
 
-def ActuallyLoad():
-    global preset
-    global samples
-    global playingsounds
-    global globalvolume, globaltranspose
-    playingsounds = []
-    samples = {}
-    globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
-    globaltranspose = 0
+def LoadParts():
+    global LoadingInterrupt
+    with loadinglock:
+        part = loadqueue[0]
+        LoadingInterrupt = False
+    while True:
+        try:
+            ActuallyLoad(part)
+        except Exception as e:                  # the thread must go on, or the part would stay queued forever
+            print 'Error loading preset %s: %s' % (part.preset, e)
+        with loadinglock:                       # the thread ends when the queue is empty, so LoadSamples starts another one
+            if not LoadingInterrupt:            # otherwise, load its new preset
+                loadqueue.pop(0)
+            if not loadqueue:
+                return
+            part = loadqueue[0]
+            LoadingInterrupt = False
 
-    samplesdir = SAMPLES_DIR if os.listdir(SAMPLES_DIR) else '.'      # use current folder (containing 0 Saw) if no user media containing samples has been found
+NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
 
-    basename = next((f for f in os.listdir(samplesdir) if f.startswith("%d " % preset)), None)      # or next(glob.iglob("blah*"), None)
-    if basename:
-        dirname = os.path.join(samplesdir, basename)
-    if not basename:
-        print 'Preset empty: %s' % preset
-        display("E%03d" % preset)
-        lcd_string('%s Preset Empty' % preset, 1)
-        return
-    print 'Preset loading: %s (%s)' % (preset, basename)
-    display("L%03d" % preset)
-    lcd_string('%s' % (basename), 1)
-    lcd_string('Loading...', 2)
 
+def ParseDefinition(dirname):
+    # returns the %%global parameters of a sample-set and the list of its samples as (filename, midinote, velocity, seq)
+    params = {}
+    entries = []
     definitionfname = os.path.join(dirname, "definition.txt")
     if os.path.isfile(definitionfname):
+        fnames = os.listdir(dirname)
         with open(definitionfname, 'r') as definitionfile:
             for i, pattern in enumerate(definitionfile):
+                if LoadingInterrupt:
+                    return None, None
                 try:
                     if r'%%volume' in pattern:        # %%paramaters are global parameters
-                        globalvolume *= 10 ** (float(pattern.split('=')[1].strip()) / 20)
+                        params['volume'] = params.get('volume', 0.0) + float(pattern.split('=')[1].strip())
                         continue
                     if r'%%transpose' in pattern:
-                        globaltranspose = int(pattern.split('=')[1].strip())
+                        params['transpose'] = int(pattern.split('=')[1].strip())
+                        continue
+                    if r'%%loopcrossfade' in pattern:
+                        params['loopcrossfade'] = max(0.0, float(pattern.split('=')[1].strip()))
+                        continue
+                    if r'%%pan' in pattern:
+                        params['pan'] = max(-1.0, min(1.0, float(pattern.split('=')[1].strip())))
+                        continue
+                    effect = re.match(r'\s*%%(' + '|'.join(EFFECTS_PARAMS) + r')\s*=', pattern)
+                    if effect:                          # master effects
+                        params[effect.group(1)] = float(pattern.split('=')[1].strip())
+                        continue
+                    if r'%%interpolation' in pattern:
+                        interpolation = pattern.split('=')[1].strip().lower()
+                        if interpolation not in samplerbox_audio.INTERPOLATIONS:
+                            raise ValueError
+                        params['interpolation'] = interpolation
                         continue
                     defaultparams = {'midinote': '0', 'velocity': '127', 'notename': '', 'seq': 1}
                     if len(pattern.split(',')) > 1:
@@ -325,10 +621,9 @@ def ActuallyLoad():
                     pattern = pattern.replace(r"\%midinote", r"(?P<midinote>\d+)").replace(r"\%velocity", r"(?P<velocity>\d+)")\
                                      .replace(r"\%seq", r"(?P<seq>\d+)")\
                                      .replace(r"\%notename", r"(?P<notename>[A-Ga-g]#?[0-9])").replace(r"\*", r".*?").strip()    # .*? => non greedy
-                    for fname in os.listdir(dirname):
-                        if LoadingInterrupt:
-                            return
-                        m = re.match(pattern, fname)
+                    regex = re.compile(pattern)
+                    for fname in fnames:
+                        m = regex.match(fname)
                         if m:
                             info = m.groupdict()
                             midinote = int(info.get('midinote', defaultparams['midinote']))
@@ -337,62 +632,542 @@ def ActuallyLoad():
                             notename = info.get('notename', defaultparams['notename'])
                             if notename:
                                 midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
-                            # print "Loaded note %s, velocity %s, seq %s." % (midinote, velocity, seq)
-                            if (midinote, velocity) in samples:
-                                samples[midinote, velocity].append(Sound(os.path.join(dirname, fname), midinote, velocity, seq))
-                            else: 
-                                samples[midinote, velocity] = [Sound(os.path.join(dirname, fname), midinote, velocity, seq)]
+                            entries.append((fname, midinote, velocity, seq))
                 except:
                     print "Error in definition file, skipping line %s." % (i+1)
 
     else:
         for midinote in range(0, 127):
+            if os.path.isfile(os.path.join(dirname, "%d.wav" % midinote)):
+                entries.append(("%d.wav" % midinote, midinote, 127, 1))
+
+    return params, entries
+
+
+sharedsounds = weakref.WeakValueDictionary()      # {(device, inode, mtime): Sound} of the files in memory, whatever preset they belong to
+sharedsoundslock = threading.Lock()
+
+
+def LoadSound(task):
+    dirname, loopcrossfade, fname, midinote, velocity, seq = task
+    if LoadingInterrupt:
+        return None
+    try:
+        filename = os.path.join(dirname, fname)
+        st = os.stat(filename)
+        key = (st.st_dev, st.st_ino, st.st_mtime, loopcrossfade)
+        with sharedsoundslock:
+            shared = sharedsounds.get(key)
+        if shared:                              # already loaded by another preset, or for another note: share its frames
+            sound = copy.copy(shared)
+            sound.midinote, sound.velocity, sound.seq = midinote, velocity, seq
+            sound.shared = shared               # keeps it in sharedsounds as long as its frames are used
+            return sound
+        sound = Sound(filename, midinote, velocity, seq, loopcrossfade=loopcrossfade)
+        with sharedsoundslock:
+            sharedsounds[key] = sound
+        return sound
+    except:
+        print "Error loading sample %s." % fname
+        return None
+
+
+def PresetParams(params):
+    # global volume, transpose, interpolation and pan of a preset from its %%parameters
+    return (10 ** ((-12.0 + params.get('volume', 0.0)) / 20),       # -12dB default global volume
+            params.get('transpose', 0),
+            samplerbox_audio.INTERPOLATIONS[params.get('interpolation', INTERPOLATION)],
+            params.get('pan', 0.0))
+
+
+EFFECTS_PARAMS = ['eqlow', 'eqmid', 'eqhigh', 'reverbroom', 'reverbdamp', 'reverb', 'limiter']
+
+
+def PresetEffects(part, params):
+    # the master effects are set by the preset of the first part (MIDI channel 1)
+    if part is parts[0]:
+        effects.configure(**dict((name, params[name]) for name in EFFECTS_PARAMS if name in params))
+
+
+presetcache = collections.OrderedDict()      # {dirname: (signature, params, SampleMap, {id(data): bytes})}, least recently used first
+
+
+def PresetCacheTrim(budget):
+    # forgets the least recently used presets until the frames of the cached ones (shared frames counted once) fit in budget bytes
+    while presetcache:
+        used = {}
+        for signature, params, samplemap, datasizes in presetcache.values():
+            used.update(datasizes)
+        if sum(used.values()) <= budget:
+            break
+        presetcache.popitem(last=False)
+
+
+def MemoryAvailable():
+    # bytes of RAM available for new allocations, or None if unknown
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def PresetSize(dirname, entries):
+    # upper bound of the RAM used by the decoded samples (exact for 16-bit files, 24-bit ones shrink when converted)
+    size = 0
+    for fname, midinote, velocity, seq in entries:
+        filesize = os.path.getsize(os.path.join(dirname, fname))
+        size += min(filesize, 4 * STREAMING_PRELOAD_FRAMES) if USE_DISK_STREAMING else filesize
+    return size
+
+
+def ActuallyLoad(part):
+    preset = part.preset
+    channel = ' (channel %i)' % (part.index + 1) if MULTITIMBRAL else ''
+    samplesdir = SAMPLES_DIR if os.listdir(SAMPLES_DIR) else '.'      # use current folder (containing 0 Saw) if no user media containing samples has been found
+
+    basename = next((f for f in os.listdir(samplesdir) if f.startswith("%d " % preset) and os.path.isdir(os.path.join(samplesdir, f))), None)      # or next(glob.iglob("blah*"), None)
+    if basename:
+        dirname = os.path.join(samplesdir, basename)
+    if not basename:
+        part.samples = SampleMap()
+        part.source = None
+        PresetEffects(part, {})
+        print 'Preset empty: %s%s' % (preset, channel)
+        display("E%03d" % preset)
+        lcd_string('%s Preset Empty' % preset, 1)
+        return
+    signature = BankSignature(dirname)
+    cached = presetcache.pop(dirname, None)
+    if cached and cached[0] == signature:      # unchanged since it was last played: swap it in
+        presetcache[dirname] = cached
+    else:                                      # or played by another part (e.g. layered with another transpose)
+        cached = next(((signature, other.source[2], other.samples) for other in parts
+                       if other is not part and other.source and other.source[:2] == (dirname, signature)), None)
+    if cached and cached[0] == signature:
+        part.samples = cached[2]
+        part.volume, part.transpose, part.interpolation, part.pan = PresetParams(cached[1])
+        PresetEffects(part, cached[1])
+        part.source = (dirname, signature, cached[1])
+        print 'Preset loaded from cache: %s (%s)%s' % (preset, basename, channel)
+        display("%04d" % preset)
+        lcd_string('%s' % (basename), 1)
+        lcd_string('', 2)
+        AutotunePreset()
+        return
+    print 'Preset loading: %s (%s)%s' % (preset, basename, channel)
+    display("L%03d" % preset)
+    lcd_string('%s' % (basename), 1)
+    lcd_string('Loading...', 2)
+
+    params, sounds = LoadBank(dirname)
+    if sounds is None:
+        params, entries = ParseDefinition(dirname)
+        if entries is None:
+            return
+        entries.sort(key=lambda e: (e[3] != 1, e[1]))        # lowest notes first (the notes above them play them pitched), alternate round-robin samples last
+        presetsize = PresetSize(dirname, entries)
+        tasks = [(dirname, params.get('loopcrossfade', 0)) + entry for entry in entries]
+        if USE_LOADER_PROCESS and not USE_DISK_STREAMING:
+            pool = None
+            sounds = LoaderSounds(dirname, tasks)
+        else:
+            pool = ThreadPool(LOADING_THREADS)
+            sounds = pool.imap_unordered(LoadSound, tasks)
+    else:
+        presetsize = 0                          # memory-mapped: the kernel can evict it
+        pool = None
+
+    # The new preset's SampleMap is built while the current one keeps playing, and swapped in when ready.
+    # If both don't fit in RAM, the cached presets and then the current one are freed first, and the new
+    # one plays while it loads.
+    available = MemoryAvailable()
+    doublebuffer = available is None or presetsize + MEMORY_RESERVE_MB * 1048576 < available
+    if not doublebuffer and presetcache:
+        PresetCacheTrim(0)
+        available = MemoryAvailable()
+        doublebuffer = available is None or presetsize + MEMORY_RESERVE_MB * 1048576 < available
+    if not doublebuffer:
+        print 'Not enough memory to keep the current preset while loading (%i MB needed)' % (presetsize / 1048576)
+        midievents.push(0xB0 | part.index, 120, 0, time.time())
+        part.playingnotes = {}
+        part.sustainplayingnotes = []
+        part.samples = SampleMap()
+        part.source = None
+        part.volume, part.transpose, part.interpolation, part.pan = PresetParams(params)
+        PresetEffects(part, params)
+
+    loaded = {}
+    lastfill = 0
+    try:
+        for sound in sounds:                    # notes become playable as soon as their samples land
             if LoadingInterrupt:
                 return
-            file = os.path.join(dirname, "%d.wav" % midinote)
-            if os.path.isfile(file):
-                samples[midinote, 127] = [ Sound(file, midinote, 127, 1) ]
-
-    initial_keys = set(samples.keys())
-    for midinote in xrange(128):
-        lastvelocity = None
-        for velocity in xrange(128):
-            if (midinote, velocity) not in initial_keys:
-                samples[midinote, velocity] = lastvelocity
-            else:
-                if not lastvelocity:
-                    for v in xrange(velocity):
-                        samples[midinote, v] = samples[midinote, velocity]
-                lastvelocity = samples[midinote, velocity]
-        if not lastvelocity:
-            for velocity in xrange(128):
-                try:
-                    samples[midinote, velocity] = samples[midinote-1, velocity]
-                except:
-                    pass
-    if len(initial_keys) > 0:
-        print 'Preset loaded: ' + str(preset)
+            if sound:
+                loaded.setdefault((sound.midinote, sound.velocity), []).append(sound)
+                if not doublebuffer and time.time() - lastfill > LOADING_FILL_INTERVAL:
+                    part.samples = SampleMap(loaded, part.samples)
+                    lastfill = time.time()
+    finally:
+        if pool:
+            pool.terminate()
+    if LoadingInterrupt:
+        return
+    part.samples = SampleMap(loaded, None if doublebuffer else part.samples)
+    part.volume, part.transpose, part.interpolation, part.pan = PresetParams(params)
+    PresetEffects(part, params)
+    part.source = (dirname, signature, params) if loaded else None
+    if RESAMPLE_CACHE_MB and loaded:            # the filled-in notes are pitched in real time until their resampled sounds are ready
+        available = MemoryAvailable()
+        budget = RESAMPLE_CACHE_MB * 1048576 if available is None else min(RESAMPLE_CACHE_MB * 1048576, available - MEMORY_RESERVE_MB * 1048576)
+        resampled = ResampleNotes(loaded, budget)
+        if resampled is None:
+            return
+        loaded.update(resampled)
+        part.samples = SampleMap(loaded, part.samples)
+    if PRESET_CACHE_MB and loaded:
+        datasizes = dict((id(sound.data), 0 if isinstance(sound.data, numpy.memmap) and not sound.data.filename.startswith(LOADER_SHM_DIR) else sound.data.nbytes)
+                         for sounds in loaded.values() for sound in sounds)
+        presetcache[dirname] = (signature, params, part.samples, datasizes)
+        PresetCacheTrim(PRESET_CACHE_MB * 1048576)
+
+    if len(loaded) > 0:
+        print 'Preset loaded: %s%s' % (preset, channel)
         display("%04d" % preset)
         lcd_string('%s' % (basename), 1)
         lcd_string('', 2)
+        AutotunePreset()
     else:
-        print 'Preset empty: ' + str(preset)
+        print 'Preset empty: %s%s' % (preset, channel)
         display("E%03d" % preset)
         lcd_string('%s Preset Empty' % (preset), 1)
 	
 
 #########################################
-# OPEN AUDIO DEVICE
+# PRESET BANKS
+# (one precompiled file per sample-set)
+#########################################
+
+# A bank file holds an 8-byte magic, the length of a JSON header, the JSON header (%%global parameters,
+# sample map, loop points, and a signature of the directory it was compiled from), padding, and one
+# contiguous blob of int16 frames that is memory-mapped when the preset is loaded.
+
+BANK_FILENAME = "samplerbox.bank"
+BANK_MAGIC = "SBBANK02"                 # banks of another version are ignored (and loaded from the WAV files) until compiled again
+BANK_PREFAULT_FRAMES = 4096             # touched at load so that note-ons don't page-fault in the audio thread
+
+
+class BankSound(Sound):
+
+    def __init__(self, filename, midinote, velocity, seq, data, loop, nframes, channels, framerate):
+        self.fname = filename
+        self.midinote = midinote
+        self.velocity = velocity
+        self.seq = seq
+        self.loop = loop
+        self.nframes = nframes
+        self.channels = channels
+        self.framerate = framerate
+        self.streamed = False
+        self.data = data
+
+
+def BankSignature(dirname):
+    signature = {}
+    for fname in os.listdir(dirname):
+        if not fname.startswith(BANK_FILENAME):
+            st = os.stat(os.path.join(dirname, fname))
+            signature[fname] = [st.st_size, int(st.st_mtime)]
+    return signature
+
+
+def CompileBank(dirname, bankfname=None):
+    params, entries = ParseDefinition(dirname)
+    header = {'params': params, 'signature': BankSignature(dirname), 'sounds': []}
+    blob = []
+    offset = 0
+    for fname, midinote, velocity, seq in entries:
+        try:
+            sound = Sound(os.path.join(dirname, fname), midinote, velocity, seq, streaming=False, loopcrossfade=params.get('loopcrossfade', 0))
+        except:
+            print "Error loading sample %s." % fname
+            continue
+        header['sounds'].append({'fname': fname, 'midinote': midinote, 'velocity': velocity, 'seq': seq,
+                                 'loop': sound.loop, 'nframes': sound.nframes, 'channels': sound.channels, 'framerate': sound.framerate, 'offset': offset, 'size': len(sound.data)})
+        blob.append(sound.data)
+        offset += len(sound.data)
+    headerdata = json.dumps(header, encoding='latin-1')     # file names are bytes in any charset, which latin-1 maps one to one
+    headerdata += ' ' * (-(len(BANK_MAGIC) + 4 + len(headerdata)) % 16)      # the frames blob starts 16-byte aligned
+    bankfname = bankfname or os.path.join(dirname, BANK_FILENAME)
+    with open(bankfname + '.tmp', 'wb') as f:
+        f.write(BANK_MAGIC)
+        f.write(struct.pack('<I', len(headerdata)))
+        f.write(headerdata)
+        for i in xrange(len(blob)):
+            f.write(blob[i].astype('<i2').tostring())
+            blob[i] = None                      # so that a bank in shared memory doesn't need twice the RAM
+    os.rename(bankfname + '.tmp', bankfname)
+    print 'Bank compiled: %s (%i samples, %i MB)' % (bankfname, len(blob), offset * 2 / 1048576)
+
+
+def LoadBank(dirname, bankfname=None):
+    # returns the %%global parameters and the sounds of a sample-set, or (None, None) if it has no up-to-date bank
+    bankfname = bankfname or os.path.join(dirname, BANK_FILENAME)
+    if not os.path.isfile(bankfname):
+        return None, None
+    try:
+        with open(bankfname, 'rb') as f:
+            if f.read(len(BANK_MAGIC)) != BANK_MAGIC:
+                raise ValueError
+            headerlength = struct.unpack('<I', f.read(4))[0]
+            header = json.loads(f.read(headerlength))
+        signature = dict((fname.encode('latin-1'), st) for fname, st in header['signature'].items())
+        if signature != BankSignature(dirname):
+            print 'Bank out of date, loading samples: %s' % bankfname
+            return None, None
+        sounds = []
+        if header['sounds']:
+            blob = numpy.memmap(bankfname, dtype=numpy.int16, mode='r', offset=len(BANK_MAGIC) + 4 + headerlength)
+            for s in header['sounds']:
+                data = blob[s['offset']:s['offset'] + s['size']]
+                channels = s.get('channels', 2)         # banks compiled before mono storage hold stereo frames
+                data[:channels * BANK_PREFAULT_FRAMES].sum()
+                sounds.append(BankSound(os.path.join(dirname, s['fname'].encode('latin-1')), s['midinote'], s['velocity'], s['seq'], data, s['loop'], s['nframes'], channels, s.get('framerate', 44100)))
+        return header['params'], sounds
+    except:
+        print 'Invalid bank, loading samples: %s' % bankfname
+        return None, None
+
+
+#########################################
+# LOADER PROCESS
+# (decodes the samples into a bank in shared memory, that is then memory-mapped without copy)
+#########################################
+
+loader = None
+
+
+def LoaderCompile(dirname):
+    # returns the name of a bank of the sample-set compiled by the loader process, or None if it failed or was interrupted
+    global loader
+    if loader is None or loader.poll() is not None:
+        loader = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--loader'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  preexec_fn=lambda: os.nice(10))                # below the audio process
+    fd, bankfname = tempfile.mkstemp(prefix='samplerbox-', suffix='.bank', dir=LOADER_SHM_DIR)
+    os.close(fd)
+    try:
+        loader.stdin.write(json.dumps([dirname, bankfname], encoding='latin-1') + '\n')     # paths are bytes, like the file names of a bank
+        loader.stdin.flush()
+        while not select.select([loader.stdout], [], [], 0.05)[0]:
+            if LoadingInterrupt:
+                loader.kill()
+                loader.wait()
+                loader = None
+                break
+        if loader and loader.stdout.readline().strip() == 'ok':
+            return bankfname
+    except (IOError, OSError) as e:
+        print 'Loader process error: %s' % e
+    for fname in (bankfname, bankfname + '.tmp'):     # a killed loader leaves its unfinished bank
+        if os.path.exists(fname):
+            os.remove(fname)
+    return None
+
+
+def LoaderSounds(dirname, tasks):
+    # yields the sounds of a sample-set, decoded in the loader process (or in this one if the loader process failed)
+    bankfname = LoaderCompile(dirname)
+    if bankfname:
+        try:
+            if LoadingInterrupt:
+                return
+            params, sounds = LoadBank(dirname, bankfname)
+        finally:
+            os.remove(bankfname)                # the memory is freed when the last sound mapping it is
+        if sounds is not None:
+            for sound in sounds:
+                yield sound
+            return
+    if LoadingInterrupt:
+        return
+    print 'Loader process failed, loading samples: %s' % dirname
+    for task in tasks:
+        yield LoadSound(task)
+
+
+#########################################
+# COMPILE PRESET BANKS
+# usage: python samplerbox.py --compile "/media/1 Piano" ...
+#########################################
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == '--compile':
+    for dirname in sys.argv[2:]:
+        CompileBank(dirname)
+    sys.exit(0)
+
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == '--loader':       # the loader process, started by LoaderCompile
+    replies = os.fdopen(os.dup(1), 'w')
+    sys.stdout = sys.stderr                     # stdout carries the replies, messages go to the console
+    for line in iter(sys.stdin.readline, ''):
+        dirname, bankfname = [path.encode('latin-1') for path in json.loads(line)]
+        try:
+            CompileBank(dirname, bankfname)
+            replies.write('ok\n')
+        except Exception as e:
+            print 'Loader process error: %s' % e
+            replies.write('error\n')
+        replies.flush()
+    sys.exit(0)
+
+
+#########################################
+# DISK STREAMING THREAD
 #
 #########################################
 
-try:
-    sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=512, samplerate=44100, channels=2, dtype='int16', callback=AudioCallback)
+StreamingEvent = threading.Event()
+
+
+def Streaming():
+    while True:
+        StreamingEvent.wait(0.005)
+        StreamingEvent.clear()
+        for snd in streamingvoices[:]:
+            if not voices.isplaying(snd.voice):
+                streamingvoices.remove(snd)
+                snd.close()
+            elif snd.filled < snd.sound.nframes:
+                try:
+                    snd.refill()
+                except IOError:
+                    print 'Streaming error: %s' % snd.sound.fname
+                    snd.stop()
+
+
+def StreamingRing():
+    # a ring buffer for a streamed voice (mono ones use its first half), with its pages already mapped
+    ring = numpy.empty(2 * STREAMING_RING_FRAMES, numpy.int16)
+    ring.fill(0)
+    return ring
+
+streamingrings = []                     # the ring buffers of no voice, taken by the note-ons without allocation
+
+if USE_DISK_STREAMING:
+    streamingrings = [StreamingRing() for i in xrange(MAX_POLYPHONY + STREAMING_SPARE_RINGS)]
+    StreamingThread = threading.Thread(target=Streaming)
+    StreamingThread.daemon = True
+    StreamingThread.start()
+
+
+#########################################
+# TELEMETRY THREAD
+#
+#########################################
+
+def TelemetryExport():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if TELEMETRY_PORT else None
+    while True:
+        time.sleep(TELEMETRY_INTERVAL)
+        stats = telemetry.snapshot()
+        stats.update(time=time.time(), preset=parts[0].preset, voices=len(voices), steals=voices.steals, midi_dropped=midievents.dropped)
+        line = json.dumps(stats, sort_keys=True)
+        try:
+            if TELEMETRY_LOG:
+                with open(TELEMETRY_LOG, 'a') as f:
+                    f.write(line + '\n')
+            if sock:
+                sock.sendto(line, ('127.0.0.1', TELEMETRY_PORT))
+        except (IOError, socket.error) as e:
+            print 'Telemetry error: %s' % e
+
+if TELEMETRY_LOG or TELEMETRY_PORT:
+    TelemetryThread = threading.Thread(target=TelemetryExport)
+    TelemetryThread.daemon = True
+    TelemetryThread.start()
+
+
+#########################################
+# AUDIO DEVICE
+# AND BLOCK SIZE AUTOTUNE
+#########################################
+
+AUTOTUNE_BLOCKSIZES = [64, 128, 256, 512, 1024, 2048]
+AUTOTUNE_LATENCY_BLOCKS = 2             # PortAudio output latency asked for with an autotuned block size, in blocks
+sd = None
+tunedinterpolation = None
+
+
+def Autotune(interpolation):
+    # returns the smallest block size for which the mix of MAX_POLYPHONY voices takes less than AUTOTUNE_HEADROOM
+    # of the block duration (99th percentile), measured on noise so that the caches don't help
+    nframes = 4 * SAMPLERATE
+    data = numpy.random.RandomState(0).uniform(-8000, 8000, 2 * (nframes + samplerbox_audio.LOOP_GUARD_FRAMES)).astype(numpy.int16)
+    for blocksize in AUTOTUNE_BLOCKSIZES:
+        pool = samplerbox_audio.VoicePool(MAX_POLYPHONY, threads=MIXER_THREADS)
+        for v in xrange(MAX_POLYPHONY):
+            pool.play(data, nframes, SAMPLERATE, SPEED[v % 24], 60, offset=v % blocksize, interpolation=interpolation)
+        out = numpy.zeros((blocksize, 2), numpy.int16)
+        times = []
+        for b in xrange(max(32, SAMPLERATE / 4 / blocksize)):
+            t = time.time()
+            pool.mix(out, blocksize, FADEOUT, FADEOUTLENGTH)
+            times.append(time.time() - t)
+        times.sort()
+        if times[len(times) * 99 / 100] < AUTOTUNE_HEADROOM * blocksize / SAMPLERATE:
+            return blocksize
+    return AUTOTUNE_BLOCKSIZES[-1]
+
+
+def OpenAudio(blocksize, latency):
+    global sd
+    import sounddevice
+    if sd:
+        sd.close()
+    sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=blocksize, latency=latency, samplerate=SAMPLERATE, channels=2, dtype='int16', callback=AudioCallback)
     sd.start()
-    print 'Opened audio device #%i' % AUDIO_DEVICE_ID
-except:
-    print 'Invalid audio device #%i' % AUDIO_DEVICE_ID
-    exit(1)
+    print 'Opened audio device #%i (%s): %i Hz, %i frames per block, %.1f ms latency' % (sd.device, sounddevice.query_devices(sd.device)['name'], SAMPLERATE, blocksize, sd.latency * 1000)
+
+
+def RetuneAudio(interpolation):
+    # measures the block size for an interpolation and (re)opens the stream with it
+    global tunedinterpolation
+    if sd:
+        sd.stop()                               # so that the audio thread doesn't disturb the measure
+    blocksize = Autotune(interpolation)
+    tunedinterpolation = interpolation
+    OpenAudio(blocksize, AUTOTUNE_LATENCY_BLOCKS * float(blocksize) / SAMPLERATE)
+
+
+def AutotunePreset():
+    # called when a preset is ready: with AUTOTUNE_PER_PRESET, a change of interpolation changes the render cost
+    # (tuned for the costliest one of the parts)
+    interpolation = max(part.interpolation for part in parts if part.source or part is parts[0])
+    if sd and not AUDIO_BLOCKSIZE and AUTOTUNE_PER_PRESET and interpolation != tunedinterpolation:
+        try:
+            RetuneAudio(interpolation)
+        except Exception as e:
+            print 'Autotune error: %s' % e
+
+
+#########################################
+# OPEN AUDIO DEVICE
+# (everything from here on only runs when samplerbox.py is started, not when
+# the engine is imported by samplerbox_render.py or samplerbox_bench.py)
+#########################################
+
+if __name__ == '__main__':
+    try:
+        if AUDIO_BLOCKSIZE:
+            OpenAudio(AUDIO_BLOCKSIZE, AUDIO_LATENCY)
+        else:
+            RetuneAudio(parts[0].interpolation)
+    except:
+        print 'Invalid audio device #%s' % AUDIO_DEVICE_ID
+        exit(1)
 
 
 #########################################
@@ -400,7 +1175,7 @@ except:
 #
 #########################################
 
-if USE_BUTTONS:
+if USE_BUTTONS and __name__ == '__main__':
     import RPi.GPIO as GPIO
 
     lastbuttontime = 0
@@ -409,22 +1184,23 @@ if USE_BUTTONS:
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(18, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.setup(17, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        global preset, lastbuttontime
+        global lastbuttontime
+        part = parts[0]                         # the buttons change the preset of MIDI channel 1
         while True:
             now = time.time()
             if not GPIO.input(18) and (now - lastbuttontime) > 0.2:
                 lastbuttontime = now
-                preset -= 1
-                if preset < 0:
-                    preset = 127
-                LoadSamples()
+                part.preset = (part.preset or 0) - 1
+                if part.preset < 0:
+                    part.preset = 127
+                LoadSamples(part)
 
             elif not GPIO.input(17) and (now - lastbuttontime) > 0.2:
                 lastbuttontime = now
-                preset += 1
-                if preset > 127:
-                    preset = 0
-                LoadSamples()
+                part.preset = (part.preset or 0) + 1
+                if part.preset > 127:
+                    part.preset = 0
+                LoadSamples(part)
 
             time.sleep(0.020)
 
@@ -433,18 +1209,70 @@ if USE_BUTTONS:
     ButtonsThread.start()
 
 
+#########################################
+# DISPLAY THREAD
+# (loading and MIDI never wait for the slow I2C displays)
+#########################################
+
+displaytext = {}                        # line -> latest text asked for, the older ones not written yet are skipped
+displaylock = threading.Lock()
+DisplayEvent = threading.Event()
+
+
+def DisplayUpdate(line, text):
+    with displaylock:
+        displaytext[line] = text
+    DisplayEvent.set()
+
+
+def DisplayThread(write, width):
+    # writes each run of changed characters with write(line, position, text)
+    shown = {}
+    while True:
+        DisplayEvent.wait()
+        DisplayEvent.clear()
+        with displaylock:
+            frame = displaytext.copy()
+        for line, text in frame.items():
+            text = text[:width].ljust(width)
+            old = shown.get(line)
+            try:
+                if old is None:
+                    write(line, 0, text)
+                else:
+                    i = 0
+                    while i < width:
+                        if text[i] == old[i]:
+                            i += 1
+                            continue
+                        j = i
+                        while j < width and text[j] != old[j]:
+                            j += 1
+                        write(line, i, text[i:j])
+                        i = j
+                shown[line] = text
+            except:
+                shown.pop(line, None)           # the whole line is written again next time
+
+
+def StartDisplayThread(write, width):
+    t = threading.Thread(target=DisplayThread, args=(write, width))
+    t.daemon = True
+    t.start()
+
+
 #########################################
 # 7-SEGMENT DISPLAY
 #
 #########################################
 
-if USE_I2C_7SEGMENTDISPLAY:
+if USE_I2C_7SEGMENTDISPLAY and __name__ == '__main__':
     import smbus
 
     bus = smbus.SMBus(1)     # using I2C
 
-    def display(s):
-        for k in '\x76\x79\x00' + s:     # position cursor at 0
+    def SegmentWrite(line, position, s):
+        for k in '\x79' + chr(position) + s:     # position cursor, then the digits
             try:
                 bus.write_byte(0x71, ord(k))
             except:
@@ -453,14 +1281,19 @@ if USE_I2C_7SEGMENTDISPLAY:
                 except:
                     pass
             time.sleep(0.002)
-            
+
+    def display(s):
+        DisplayUpdate(0, s)
+
     def lcd_string(s, line):
         pass
 
+    bus.write_byte(0x71, 0x76)      # clear
+    StartDisplayThread(SegmentWrite, 4)
     display('----')
     time.sleep(0.5)
 
-elif USE_I2C_16X2DISPLAY:
+elif USE_I2C_16X2DISPLAY and __name__ == '__main__':
 	
 	import smbus
 
@@ -472,6 +1305,7 @@ elif USE_I2C_16X2DISPLAY:
 	LCD_LINE_2 = 0xC0 # LCD RAM address for the 2nd line
 	LCD_LINE_3 = 0x94 # LCD RAM address for the 3rd line
 	LCD_LINE_4 = 0xD4 # LCD RAM address for the 4th line
+	LCD_LINES = {1: LCD_LINE_1, 2: LCD_LINE_2, 3: LCD_LINE_3, 4: LCD_LINE_4}
 	
 	LCD_BACKLIGHT  = 0x08  # On
 	#LCD_BACKLIGHT = 0x00  # Off
@@ -519,30 +1353,20 @@ elif USE_I2C_16X2DISPLAY:
 	  bus.write_byte(I2C_16x2DISPLAY_ADDR,(bits & ~ENABLE))
 	  time.sleep(E_DELAY)
 	  
-	def lcd_string(message,line):
-		if line == 1:
-			line_address = LCD_LINE_1
-		elif line == 2:
-			line_address = LCD_LINE_2
-		elif line == 3:
-			line_address = LCD_LINE_3
-		elif line == 4:
-			line_address = LCD_LINE_4
-		
-		
-		# Send string to display
+	def lcd_write(line, position, message):
+		# Send characters to display, from position of line (the cursor moves right after each character)
+		lcd_byte(LCD_LINES[line] + position, LCD_CMD)
+		for c in message:
+			lcd_byte(ord(c),LCD_CHR)
 
-		message = message.ljust(I2C_16x2DISPLAY_LCD_WIDTH," ")
-
-		lcd_byte(line_address, LCD_CMD)
-
-		for i in range(I2C_16x2DISPLAY_LCD_WIDTH):
-			lcd_byte(ord(message[i]),LCD_CHR)
+	def lcd_string(message,line):
+		DisplayUpdate(line, message)
 	
 	def display(s):
 		pass
 	
 	lcd_init()
+	StartDisplayThread(lcd_write, I2C_16x2DISPLAY_LCD_WIDTH)
 	display('----')
 	time.sleep(0.5)
 	
@@ -554,30 +1378,116 @@ else:
         pass
 
 
+#########################################
+# MIDI INPUT
+# (all the ports merged into one stream)
+#########################################
+
+MIDI_MESSAGE_TYPES = {'note': (8, 9), 'polypressure': (10,), 'control': (11,), 'program': (12,), 'pressure': (13,), 'pitchbend': (14,)}
+midiinput = []                          # (timestamp, port, message) received and not dispatched yet
+midiinputcondition = threading.Condition()
+
+
+def MidiInput(port, message, timestamp=None):
+    # called by the threads of the ports: the messages are stamped and queued in the order they arrive
+    with midiinputcondition:
+        midiinput.append((time.time() if timestamp is None else timestamp, port, message))
+        midiinputcondition.notify()
+
+
+def MidiRoute(port, message):
+    # applies the MIDI_PORT_ROUTING of a port to a message; returns the message to play, or None
+    rules = next((rules for name, rules in MIDI_PORT_ROUTING.items() if name in port), None)
+    if not rules or not message or message[0] >= 0xF0:
+        return message
+    if 'channels' in rules and (message[0] & 15) + 1 not in rules['channels']:
+        return None
+    if any(message[0] >> 4 in MIDI_MESSAGE_TYPES.get(name, ()) for name in rules.get('ignore', [])):
+        return None
+    if 'channel' in rules:
+        return [(message[0] & 0xF0) | (rules['channel'] - 1)] + list(message[1:])
+    return message
+
+
+def MidiDispatch():
+    # the only thread that passes MIDI messages to the engine, in the order of their timestamps (the serial port
+    # stamps them with the arrival of their last byte, estimated from the time of the read)
+    while True:
+        with midiinputcondition:
+            while not midiinput:
+                midiinputcondition.wait()
+            batch = sorted(midiinput, key=lambda event: event[0])
+            del midiinput[:]
+        for timestamp, port, message in batch:
+            message = MidiRoute(port, message)
+            if message:
+                MidiCallback(message, None, timestamp)
+
+if __name__ == '__main__':
+    MidiDispatchThread = threading.Thread(target=MidiDispatch)
+    MidiDispatchThread.daemon = True
+    MidiDispatchThread.start()
+
+
+#########################################
+# MIDI BYTE STREAM PARSER
+# (http://www.midi.org/techspecs/midimessages.php)
+#########################################
+
+CHANNEL_DATA_LENGTH = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}     # by message type
+SYSTEM_DATA_LENGTH = {0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0}                           # by status, for system common messages
+SERIAL_BYTE_DURATION = 10 / 31250.0     # a MIDI byte is 10 bits long on the wire (start, 8 data, stop)
+
+
+class MidiParser:
+    # Turns a stream of MIDI bytes into messages, passed to callback(message, timestamp). It keeps the running
+    # status, skips SysEx and passes the realtime bytes (clock, start, stop...) as soon as they arrive, even in
+    # the middle of another message, which they don't interrupt.
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.status = 0                 # running status, 0 when the data bytes are to be ignored (SysEx, undefined status)
+        self.expected = 0               # data bytes of the current message
+        self.message = []
+
+    def feed(self, data, now, byteduration=0):
+        # data was received by now, its bytes arrived every byteduration seconds
+        last = len(data) - 1
+        for i, byte in enumerate(bytearray(data)):
+            if byte >= 0xF8:
+                self.callback([byte], now - (last - i) * byteduration)
+            elif byte >= 0x80:
+                self.message = [byte]
+                self.expected = CHANNEL_DATA_LENGTH[byte >> 4] if byte < 0xF0 else SYSTEM_DATA_LENGTH.get(byte, -1)
+                self.status = byte if self.expected >= 0 else 0
+                if self.expected == 0:
+                    self.callback(self.message, now - (last - i) * byteduration)
+                    self.status = 0
+            elif self.status:
+                self.message.append(byte)
+                if len(self.message) > self.expected:
+                    self.callback(self.message, now - (last - i) * byteduration)
+                    if self.status < 0xF0:
+                        self.message = [self.status]    # running status: the next data bytes use the same status
+                    else:
+                        self.status = 0                 # system common messages cancel the running status
+
+
 #########################################
 # MIDI IN via SERIAL PORT
 #
 #########################################
 
-if USE_SERIALPORT_MIDI:
+if USE_SERIALPORT_MIDI and __name__ == '__main__':
     import serial
 
     ser = serial.Serial('/dev/ttyAMA0', baudrate=38400)       # see hack in /boot/cmline.txt : 38400 is 31250 baud for MIDI!
 
     def MidiSerialCallback():
-        message = [0, 0, 0]
+        parser = MidiParser(lambda message, timestamp: MidiInput('Serial', message, timestamp))
         while True:
-            i = 0
-            while i < 3:
-                data = ord(ser.read(1))  # read a byte
-                if data >> 7 != 0:
-                    i = 0      # status byte!   this is the beginning of a midi message: http://www.midi.org/techspecs/midimessages.php
-                message[i] = data
-                i += 1
-                if i == 2 and message[0] >> 4 == 12:  # program change: don't wait for a third byte: it has only 2 bytes
-                    message[2] = 0
-                    i = 3
-            MidiCallback(message, None)
+            data = ser.read(max(1, ser.inWaiting()))          # waits for a byte, then takes all the bytes already received
+            parser.feed(data, time.time(), SERIAL_BYTE_DURATION)
 
     MidiThread = threading.Thread(target=MidiSerialCallback)
     MidiThread.daemon = True
@@ -589,8 +1499,12 @@ if USE_SERIALPORT_MIDI:
 #
 #########################################
 
-preset = 0
-LoadSamples()
+for channel, preset in (PART_PRESETS if MULTITIMBRAL else {1: 0}).items():
+    parts[channel - 1].preset = preset
+if __name__ == '__main__':
+    for part in parts:
+        if part.preset is not None:
+            LoadSamples(part)
 
 
 #########################################
@@ -598,14 +1512,52 @@ LoadSamples()
 # MAIN LOOP
 #########################################
 
-midi_in = [rtmidi.MidiIn()]
-previous = []
-while True:
-    for port in midi_in[0].ports:
-        if port not in previous and 'Midi Through' not in port:
-            midi_in.append(rtmidi.MidiIn())
-            midi_in[-1].callback = MidiCallback
-            midi_in[-1].open_port(port)
+MIDI_HOTPLUG_INTERVAL = 0.1             # seconds between two checks of the sound devices (a new USB controller is opened this fast)
+MIDI_HOTPLUG_SETTLE = 1.0               # seconds for which the ports are listed after a sound device appeared or disappeared
+MIDI_RESCAN_INTERVAL = 2.0              # seconds between two listings of the ports otherwise (virtual ports have no device)
+
+
+def SoundDevices():
+    # changes when a sound card or MIDI interface is plugged or unplugged
+    try:
+        return sorted(os.listdir('/dev/snd'))
+    except OSError:
+        return None
+
+
+def MidiPorts(scanner, opened):
+    # opens the new input ports and closes those that disappeared; opened is {name: MidiIn}
+    ports = scanner.ports
+    for port in opened.keys():
+        if port not in ports:
+            opened.pop(port).close_port()
+            print 'Closed MIDI: ' + port
+    for port in ports:
+        if port not in opened and not any(ignored in port for ignored in MIDI_IGNORED_PORTS):
+            midi_in = rtmidi.MidiIn()
+            midi_in.callback = lambda message, time_stamp, port=port: MidiInput(port, message)
+            try:
+                midi_in.open_port(port)
+            except Exception as e:              # unplugged while being opened: tried again at the next listing
+                print 'MIDI error: %s (%s)' % (port, e)
+                continue
+            opened[port] = midi_in
             print 'Opened MIDI: ' + port
-    previous = midi_in[0].ports
-    time.sleep(2)
+
+if __name__ == '__main__':
+    import rtmidi_python as rtmidi
+
+    scanner = rtmidi.MidiIn()                   # only lists the ports
+    opened = {}
+    devices = SoundDevices()
+    nextscan = settle = 0
+    while True:
+        now = time.time()
+        current = SoundDevices()
+        if current != devices:
+            devices = current
+            settle = now + MIDI_HOTPLUG_SETTLE  # the ports of a new device show up a little after it
+        if now >= nextscan or now < settle:
+            MidiPorts(scanner, opened)
+            nextscan = now + MIDI_RESCAN_INTERVAL
+        time.sleep(MIDI_HOTPLUG_INTERVAL)
@@ -0,0 +1,114 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_bench.py: Benchmark of the audio engine (per-block render time, real-time factor, memory)
+#
+#  usage: python samplerbox_bench.py                              # prints a table
+#         python samplerbox_bench.py --save baseline.json         # keeps the results
+#         python samplerbox_bench.py --compare baseline.json      # fails if a case got slower than --tolerance
+#         python samplerbox_bench.py --effects                    # with the master effects (EQ, reverb and limiter) on
+#
+
+
+#########################################
+# IMPORT
+# MODULES
+#########################################
+
+import argparse
+import json
+import resource
+import sys
+import time
+import numpy
+import samplerbox
+import samplerbox_audio
+
+
+#########################################
+# BENCHMARK CASES
+#
+#########################################
+
+POLYPHONIES = [16, 40, 80, 160]
+SAMPLE_FRAMES = 10 * 44100              # long enough for one-shot voices to last the whole measure at the highest pitch
+LOOP_START = 44100
+
+
+def SampleData(channels, seed=0):
+    # a sample of noise, the worst case for the caches as every voice reads different data
+    rnd = numpy.random.RandomState(seed)
+    return (rnd.uniform(-8000, 8000, channels * (SAMPLE_FRAMES + samplerbox_audio.LOOP_GUARD_FRAMES))).astype(numpy.int16)
+
+
+def RunCase(data, channels, polyphony, looped, fading, blocks, blocksize, interpolation, threads):
+    # starts polyphony voices at various pitches and times the AudioCallback calls
+    samplerbox.voices = samplerbox_audio.VoicePool(polyphony, threads=threads)
+    gain = 10 ** (-12.0 / 20)
+    out = numpy.zeros((blocksize, 2), numpy.int16)
+    for v in xrange(polyphony):
+        voice = samplerbox.voices.play(data, SAMPLE_FRAMES, LOOP_START if looped else -1, samplerbox.SPEED[v % 24], 36 + v % 48,
+                                       offset=v % blocksize, interpolation=interpolation, channels=channels, gainl=gain, gainr=gain)
+        if fading:
+            samplerbox.voices.fadeout(voice)
+    times = numpy.zeros(blocks)
+    for b in xrange(blocks):
+        t = time.time()
+        samplerbox.AudioCallback(out, blocksize, None, None, 0.0)
+        times[b] = time.time() - t
+    return times
+
+
+def Results(args):
+    data = SampleData(args.channels)
+    if args.effects:                        # never bypassed, so that their cost is measured
+        samplerbox.effects = samplerbox_audio.Effects(samplerbox.SAMPLERATE, float('inf'))
+        samplerbox.effects.configure(eqlow=3, eqmid=-2, eqhigh=2, reverb=0.3, limiter=-1)
+    results = []
+    blockduration = float(args.blocksize) / samplerbox.SAMPLERATE
+    for polyphony in POLYPHONIES:
+        for looped in (True, False):
+            for fading in (False, True):
+                times = RunCase(data, args.channels, polyphony, looped, fading, args.blocks, args.blocksize, samplerbox_audio.INTERPOLATIONS[args.interpolation], args.threads)
+                results.append({'case': '%d %s%s' % (polyphony, 'looped' if looped else 'one-shot', ' fading' if fading else ''),
+                                'mean_us': times.mean() * 1e6,
+                                'p99_us': numpy.percentile(times, 99) * 1e6,
+                                'max_us': times.max() * 1e6,
+                                'realtime': blockduration / times.mean(),
+                                'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the SamplerBox audio engine.')
+    parser.add_argument('--blocks', type=int, default=50, help='blocks per case (fading voices last about 58 blocks of 512)')
+    parser.add_argument('--blocksize', type=int, default=512)
+    parser.add_argument('--interpolation', default=samplerbox.INTERPOLATION, choices=sorted(samplerbox_audio.INTERPOLATIONS))
+    parser.add_argument('--threads', type=int, default=samplerbox.MIXER_THREADS)
+    parser.add_argument('--channels', type=int, default=2, choices=[1, 2], help='mono or stereo samples')
+    parser.add_argument('--effects', action='store_true', help='render through the master effects')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of earlier results to compare the mean block times with')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='slowdown reported as a regression by --compare')
+    args = parser.parse_args()
+
+    results = Results(args)
+    baseline = dict((r['case'], r) for r in json.load(open(args.compare))['results']) if args.compare else {}
+    regressions = 0
+    print '%-24s %10s %10s %10s %10s %10s' % ('case', 'mean us', 'p99 us', 'max us', 'realtime', 'maxrss MB')
+    for r in results:
+        line = '%-24s %10.0f %10.0f %10.0f %9.1fx %10.1f' % (r['case'], r['mean_us'], r['p99_us'], r['max_us'], r['realtime'], r['maxrss_mb'])
+        if r['case'] in baseline:
+            change = r['mean_us'] / baseline[r['case']]['mean_us'] - 1
+            line += '   %+5.1f%%' % (change * 100)
+            if change > args.tolerance:
+                line += '  REGRESSION'
+                regressions += 1
+        print line
+    if args.save:
+        json.dump({'blocksize': args.blocksize, 'interpolation': args.interpolation, 'threads': args.threads, 'channels': args.channels, 'effects': args.effects, 'results': results}, open(args.save, 'w'), indent=1)
+    sys.exit(1 if regressions else 0)
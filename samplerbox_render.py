@@ -0,0 +1,178 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_render.py: Renders a MIDI file or a synthetic note stream through the engine to a WAV file,
+#                        without sound card or MIDI device
+#
+#  usage: python samplerbox_render.py --samples /media --preset 0 --midi song.mid out.wav
+#         python samplerbox_render.py --samples /media --preset 0 --notes 30 --polyphony 16 out.wav
+#
+
+
+#########################################
+# IMPORT
+# MODULES
+#########################################
+
+import argparse
+import random
+import struct
+import wave
+import numpy
+import samplerbox
+
+
+#########################################
+# MIDI FILE
+# (standard MIDI file, format 0 or 1)
+#########################################
+
+def ReadVarLen(data, i):
+    value = 0
+    while True:
+        byte = ord(data[i])
+        i += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, i
+
+
+def ReadMidiFile(filename):
+    # returns the channel messages of all tracks as a time-sorted list of (seconds, status, data1, data2)
+    data = open(filename, 'rb').read()
+    if data[:4] != 'MThd':
+        raise ValueError('not a MIDI file: %s' % filename)
+    headerlength, fileformat, ntracks, division = struct.unpack('>IHHH', data[4:14])
+    if division & 0x8000:
+        raise ValueError('SMPTE time division is not supported: %s' % filename)
+    events = []                             # (tick, order in the file, status, data1, data2)
+    tempos = [(0, 500000)]                  # (tick, microseconds per quarter note)
+    i = 8 + headerlength
+    for track in xrange(ntracks):
+        if data[i:i + 4] != 'MTrk':
+            break
+        length = struct.unpack('>I', data[i + 4:i + 8])[0]
+        i += 8
+        end = i + length
+        tick = 0
+        status = 0
+        while i < end:
+            delta, i = ReadVarLen(data, i)
+            tick += delta
+            byte = ord(data[i])
+            if byte == 0xFF:                # meta event
+                metatype = ord(data[i + 1])
+                metalength, i = ReadVarLen(data, i + 2)
+                if metatype == 0x51:
+                    tempos.append((tick, struct.unpack('>I', '\x00' + data[i:i + 3])[0]))
+                i += metalength
+            elif byte in (0xF0, 0xF7):      # sysex
+                sysexlength, i = ReadVarLen(data, i + 1)
+                i += sysexlength
+            else:
+                if byte & 0x80:
+                    status = byte
+                    i += 1
+                if status >> 4 in (12, 13):         # program change and channel pressure have one data byte
+                    events.append((tick, len(events), status, ord(data[i]), 0))
+                    i += 1
+                else:
+                    events.append((tick, len(events), status, ord(data[i]), ord(data[i + 1])))
+                    i += 2
+        i = end
+    tempos.sort()
+    events.sort()
+    result = []
+    tempoindex, tempotick, temposeconds = 0, 0, 0.0
+    for tick, order, status, data1, data2 in events:
+        while tempoindex + 1 < len(tempos) and tempos[tempoindex + 1][0] <= tick:
+            temposeconds += (tempos[tempoindex + 1][0] - tempotick) * tempos[tempoindex][1] / 1e6 / division
+            tempotick = tempos[tempoindex + 1][0]
+            tempoindex += 1
+        result.append((temposeconds + (tick - tempotick) * tempos[tempoindex][1] / 1e6 / division, status, data1, data2))
+    return result
+
+
+#########################################
+# SYNTHETIC NOTE STREAM
+#
+#########################################
+
+def SyntheticNotes(duration, polyphony, seed=0, notelength=2.0, sustainpedal=False):
+    # random notes spread over the keyboard, about polyphony of them held at any time
+    rnd = random.Random(seed)
+    events = []
+    interval = notelength / max(polyphony, 1)
+    t = 0.0
+    while t < duration:
+        note = rnd.randint(36, 96)
+        events.append((t, 0x90, note, rnd.randint(30, 127)))
+        events.append((t + notelength * rnd.uniform(0.5, 1.5), 0x80, note, 0))
+        t += interval * rnd.uniform(0.5, 1.5)
+    if sustainpedal:
+        for k in xrange(int(duration / 4)):
+            events.append((k * 4.0 + 0.1, 0xB0, 64, 127))
+            events.append((k * 4.0 + 3.9, 0xB0, 64, 0))
+    events.sort()
+    return events
+
+
+#########################################
+# RENDER
+#
+#########################################
+
+def Render(events, duration, blocksize=512):
+    # plays the events through AudioCallback, one block after the other, on a virtual clock
+    out = numpy.zeros((blocksize, 2), numpy.int16)
+    blocks = []
+    i = 0
+    for b in xrange(int(duration * samplerbox.SAMPLERATE / blocksize) + 1):
+        now = float((b + 1) * blocksize) / samplerbox.SAMPLERATE
+        while i < len(events) and events[i][0] < now:
+            t, status, data1, data2 = events[i]
+            if status >> 4 == 12:               # program change: wait for the preset to be loaded
+                samplerbox.MidiCallback([status, data1, data2], None)
+                samplerbox.LoadingThread.join()
+            else:
+                samplerbox.midievents.push(status, data1, data2, t)
+            i += 1
+        samplerbox.AudioCallback(out, blocksize, None, None, now)
+        blocks.append(out.copy())
+    return numpy.concatenate(blocks)
+
+
+def WriteWav(filename, frames):
+    w = wave.open(filename, 'wb')
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(samplerbox.SAMPLERATE)
+    w.writeframes(frames.astype('<i2').tostring())
+    w.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render MIDI through the SamplerBox engine to a WAV file.')
+    parser.add_argument('output', help='WAV file to write')
+    parser.add_argument('--samples', default=samplerbox.SAMPLES_DIR, help='directory containing the sample-sets')
+    parser.add_argument('--preset', type=int, default=0)
+    parser.add_argument('--midi', help='MIDI file to render (default: a synthetic note stream)')
+    parser.add_argument('--notes', type=float, default=10.0, help='duration of the synthetic note stream, in seconds')
+    parser.add_argument('--polyphony', type=int, default=8, help='notes held at once in the synthetic note stream')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tail', type=float, default=2.0, help='seconds rendered after the last event')
+    args = parser.parse_args()
+
+    samplerbox.SAMPLES_DIR = args.samples
+    samplerbox.parts[0].preset = args.preset
+    samplerbox.LoadSamples()
+    samplerbox.LoadingThread.join()
+    events = ReadMidiFile(args.midi) if args.midi else SyntheticNotes(args.notes, args.polyphony, args.seed)
+    duration = (events[-1][0] if events else 0) + args.tail
+    frames = Render(events, duration)
+    WriteWav(args.output, frames)
+    print 'Rendered %.1f s to %s' % (float(len(frames)) / samplerbox.SAMPLERATE, args.output)
@@ -0,0 +1,72 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_test.py: Tests of the MIDI byte stream parser
+#
+#  usage: python samplerbox_test.py
+#
+
+
+import unittest
+import samplerbox
+
+
+def Parse(*chunks):
+    # returns the messages parsed from chunks of bytes fed one after the other
+    messages = []
+    parser = samplerbox.MidiParser(lambda message, timestamp: messages.append(message))
+    for chunk in chunks:
+        parser.feed(bytearray(chunk), 0.0)
+    return messages
+
+
+class MidiParserTest(unittest.TestCase):
+
+    def test_messages(self):
+        self.assertEqual(Parse([0x90, 60, 100, 0x80, 60, 0, 0xE0, 0, 64]), [[0x90, 60, 100], [0x80, 60, 0], [0xE0, 0, 64]])
+
+    def test_message_split_across_reads(self):
+        self.assertEqual(Parse([0x90], [60], [100, 0xB0, 64], [127]), [[0x90, 60, 100], [0xB0, 64, 127]])
+
+    def test_running_status(self):
+        self.assertEqual(Parse([0x90, 60, 100, 62, 100, 64, 0]), [[0x90, 60, 100], [0x90, 62, 100], [0x90, 64, 0]])
+
+    def test_one_data_byte_messages(self):
+        self.assertEqual(Parse([0xC0, 5, 6, 0xD1, 64, 0x90, 60, 100]), [[0xC0, 5], [0xC0, 6], [0xD1, 64], [0x90, 60, 100]])
+
+    def test_realtime_in_the_middle_of_a_message(self):
+        self.assertEqual(Parse([0x90, 0xF8, 60, 0xFA, 100, 62, 0xFE, 100]), [[0xF8], [0xFA], [0x90, 60, 100], [0xFE], [0x90, 62, 100]])
+
+    def test_sysex_is_skipped(self):
+        self.assertEqual(Parse([0xF0, 0x7E, 0x7F, 0x06, 0x01, 0xF7, 0x90, 60, 100]), [[0x90, 60, 100]])
+
+    def test_sysex_cancels_running_status(self):
+        self.assertEqual(Parse([0x90, 60, 100, 0xF0, 0x01, 0xF7, 62, 100]), [[0x90, 60, 100]])
+
+    def test_realtime_inside_sysex(self):
+        self.assertEqual(Parse([0xF0, 0x01, 0xF8, 0x02, 0xF7]), [[0xF8]])
+
+    def test_system_common_cancels_running_status(self):
+        self.assertEqual(Parse([0x90, 60, 100, 0xF1, 0x10, 62, 100]), [[0x90, 60, 100], [0xF1, 0x10]])
+        self.assertEqual(Parse([0x90, 60, 100, 0xF6, 62, 100]), [[0x90, 60, 100], [0xF6]])
+        self.assertEqual(Parse([0xF2, 1, 2, 3]), [[0xF2, 1, 2]])
+
+    def test_data_before_any_status_is_ignored(self):
+        self.assertEqual(Parse([60, 100, 0xF4, 1, 0x90, 60, 100]), [[0x90, 60, 100]])
+
+    def test_timestamps(self):
+        # each message is stamped with the arrival of its last byte, the last byte of a read arriving at now
+        stamped = []
+        parser = samplerbox.MidiParser(lambda message, timestamp: stamped.append((message, timestamp)))
+        parser.feed(bytearray([0x90, 60, 100, 0xF8, 62, 100]), 1.0, 0.001)
+        self.assertEqual([message for message, timestamp in stamped], [[0x90, 60, 100], [0xF8], [0x90, 62, 100]])
+        for (message, timestamp), expected in zip(stamped, [0.997, 0.998, 1.0]):
+            self.assertAlmostEqual(timestamp, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
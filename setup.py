@@ -1,7 +1,10 @@
 from distutils.core import setup
-from Cython.Build import cythonize
+from distutils.extension import Extension
+from Cython.Build import cythonize                  # Cython >= 0.29.31 (noexcept functions)
 import numpy
 import os
 
 os.environ["CPPFLAGS"] = os.getenv("CPPFLAGS", "") + "-I" + numpy.get_include() 
-setup(ext_modules = cythonize("samplerbox_audio.pyx"), include_dirs=[numpy.get_include()])
\ No newline at end of file
+openmp = ["-fopenmp"] if os.getenv("SAMPLERBOX_OPENMP", "1") != "0" else []        # SAMPLERBOX_OPENMP=0 builds a single-core mixer
+extension = Extension("samplerbox_audio", ["samplerbox_audio.pyx"], extra_compile_args=openmp, extra_link_args=openmp)
+setup(ext_modules = cythonize(extension), include_dirs=[numpy.get_include()])